@@ -1,25 +1,147 @@
 import os
-import result
-import base64
-import json
+import re
+import hashlib
+import mimetypes
 import subprocess
 import shutil
+import socket
 import uuid
 import logging
 import asyncio
-from typing import List, Optional, Dict
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, BackgroundTasks
+import time
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Callable, List, Optional, Dict
+import aiohttp
+import diskcache
+import orjson
+from fastapi import FastAPI, HTTPException, UploadFile, File, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-import requests
-from ftplib import FTP
+from ftplib import FTP, error_temp
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com"
+GEMINI_MODEL = "gemini-2.0-flash"
+
+# Built once and shared by every generateContent call; only the images and user context vary
+GEMINI_METADATA_KEYS = "Title, Description, Keywords (comma separated string), Category (Choose from standard stock categories)"
+GEMINI_METADATA_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "Title": {"type": "STRING"},
+        "Description": {"type": "STRING"},
+        "Keywords": {"type": "STRING"},
+        "Category": {"type": "STRING"},
+    },
+    "required": ["Title", "Description", "Keywords", "Category"],
+}
+
+GEMINI_SYSTEM_INSTRUCTION = {
+    "parts": [{
+        "text": (
+            "Analyze this image for stock photography. "
+            f"Return JSON with keys: {GEMINI_METADATA_KEYS}. "
+            "If the user provides additional context, override visual inferences where the context contradicts them."
+        )
+    }]
+}
+GEMINI_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": GEMINI_METADATA_SCHEMA,
+}
+
+# Up to GEMINI_BATCH_SIZE images share one generateContent call, each preceded by its filename
+GEMINI_BATCH_SIZE = 8
+GEMINI_BATCH_SYSTEM_INSTRUCTION = {
+    "parts": [{
+        "text": (
+            "Analyze each of the following images for stock photography. "
+            "Each image is preceded by its filename and, optionally, additional context from the user. "
+            f"Return a JSON array with one object per image, in the same order, with keys: Filename (exactly as given), {GEMINI_METADATA_KEYS}. "
+            "Where the user provides additional context for an image, override visual inferences that contradict it."
+        )
+    }]
+}
+GEMINI_BATCH_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "ARRAY",
+        "items": {
+            "type": "OBJECT",
+            "properties": {"Filename": {"type": "STRING"}, **GEMINI_METADATA_SCHEMA["properties"]},
+            "required": ["Filename", *GEMINI_METADATA_SCHEMA["required"]],
+        },
+    },
+}
+
+# Changes to any prompt or schema invalidate cached responses
+GEMINI_PROMPT_FINGERPRINT = hashlib.blake2b(
+    orjson.dumps(
+        [GEMINI_SYSTEM_INSTRUCTION, GEMINI_GENERATION_CONFIG, GEMINI_BATCH_SYSTEM_INSTRUCTION, GEMINI_BATCH_GENERATION_CONFIG],
+        option=orjson.OPT_SORT_KEYS,
+    ),
+    digest_size=16,
+).hexdigest()
+
+# Chunk size for streaming uploads to disk
+COPY_CHUNK_SIZE = 1024 * 1024
+
+IMAGE_EXTENSIONS = frozenset({".jpg", ".jpeg", ".png"})
+
+# Images are downscaled to this longest edge before upload; Gemini resizes to ~1024px anyway
+GEMINI_MAX_EDGE = 1024
+GEMINI_JPEG_QUALITY = 85
+# Per-session cache dir for downscaled copies, removed with the session
+PREPARED_DIR = ".gemini"
+
+# Uploaded Files API handles reused by re-analysis; Gemini deletes files after 48h
+GEMINI_FILE_CACHE_SIZE = 2048
+GEMINI_FILE_TTL = 46 * 3600
+
+# Max in-flight Gemini requests per /analyze call
+GEMINI_CONCURRENCY = 16
+
+# Keep-alive pool shared by all Gemini calls so TCP/TLS handshakes are reused
+HTTP_POOL_SIZE = 32
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=60)
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Gemini rate limits (429) and transient 5xx are retried with exponential backoff, honouring Retry-After
+HTTP_MAX_RETRIES = 5
+HTTP_BACKOFF_FACTOR = 1.0
+HTTP_MAX_BACKOFF = 60
+HTTP_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+# Upper bound on the time one call may spend across all attempts and backoff
+HTTP_RETRY_DEADLINE = 120
+
+# Parallel FTP connections per /embed-and-upload call
+FTP_WORKERS = 4
+# storbinary chunk and data-socket send buffer (ftplib defaults to 8KB sends)
+FTP_BLOCKSIZE = 1024 * 1024
+FTP_SNDBUF = 4 * 1024 * 1024
+
+# Shared HTTP client, created/closed by the app lifespan for connection pooling
+http_session: Optional[aiohttp.ClientSession] = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_session
+    connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, limit_per_host=HTTP_POOL_SIZE)
+    http_session = aiohttp.ClientSession(connector=connector, timeout=HTTP_TIMEOUT)
+    try:
+        yield
+    finally:
+        await http_session.close()
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS Configuration
 app.add_middleware(
@@ -34,8 +156,25 @@ app.add_middleware(
 TEMP_DIR = "/app/temp"
 os.makedirs(TEMP_DIR, exist_ok=True)
 
+# Gemini response cache, evicting least-recently-used entries past the size limit
+CACHE_DIR = "/app/cache"
+CACHE_SIZE_LIMIT = 256 * 1024 * 1024
+response_cache = diskcache.Cache(CACHE_DIR, size_limit=CACHE_SIZE_LIMIT, eviction_policy="least-recently-used")
+
+# Session files are short-lived but embed_metadata rewrites them in place, so no "immutable":
+# after max-age browsers revalidate against the ETag/Last-Modified that FileResponse sends
+STATIC_CACHE_CONTROL = "public, max-age=3600"
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles that adds a Cache-Control header to every file response."""
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = STATIC_CACHE_CONTROL
+        return response
+
 # Mount temp dir for serving images to frontend
-app.mount("/temp", StaticFiles(directory=TEMP_DIR), name="temp")
+app.mount("/temp", CachedStaticFiles(directory=TEMP_DIR), name="temp")
 
 # --- Pydantic Models ---
 
@@ -61,12 +200,414 @@ class EmbedUploadRequest(BaseModel):
 
 # --- Helper Functions ---
 
-def cleanup_session(session_id: str):
-    """Deletes the session directory."""
+def prepare_for_gemini(session_path: str, filename: str) -> tuple:
+    """
+    Downscales an image to GEMINI_MAX_EDGE and recompresses it as JPEG,
+    caching the result under the session's PREPARED_DIR for re-analysis.
+    Returns (path, mime_type) of the file to send.
+    """
+    # Imported lazily: only /analyze needs Pillow, keeping worker startup light
+    from PIL import Image, ImageOps
+
+    filepath = os.path.join(session_path, filename)
+    prepared_path = os.path.join(session_path, PREPARED_DIR, filename + ".jpg")
+    if os.path.exists(prepared_path) and os.path.getmtime(prepared_path) >= os.path.getmtime(filepath):
+        return prepared_path, "image/jpeg"
+
+    with Image.open(filepath) as im:
+        if max(im.size) <= GEMINI_MAX_EDGE:
+            return filepath, mimetypes.guess_type(filename)[0] or "image/jpeg"
+
+        # Thumbnail first so JPEGs decode in draft mode at reduced scale; the box is square,
+        # so transposing afterwards yields the same output size
+        im.thumbnail((GEMINI_MAX_EDGE, GEMINI_MAX_EDGE), Image.LANCZOS)
+        im = ImageOps.exif_transpose(im)
+        os.makedirs(os.path.dirname(prepared_path), exist_ok=True)
+        # Write-then-rename so a concurrent /analyze or a crash never leaves a truncated JPEG in the cache
+        tmp_path = f"{prepared_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            im.convert("RGB").save(tmp_path, "JPEG", quality=GEMINI_JPEG_QUALITY, optimize=True)
+            os.replace(tmp_path, prepared_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    return prepared_path, "image/jpeg"
+
+@lru_cache(maxsize=4096)
+def _content_digest(path: str, size: int, mtime_ns: int) -> str:
+    """Streams the file through blake2b; memoized on (path, size, mtime) so unchanged files are hashed once."""
+    h = hashlib.blake2b()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def response_cache_key(filepath: str, user_context: str) -> str:
+    """Cache key for a Gemini response: model + prompt fingerprint + image content digest + user context."""
+    st = os.stat(filepath)
+    digest = _content_digest(filepath, st.st_size, st.st_mtime_ns)
+    return hashlib.blake2b(
+        f"{GEMINI_MODEL}:{GEMINI_PROMPT_FINGERPRINT}:{digest}:{user_context}".encode("utf-8"), digest_size=32
+    ).hexdigest()
+
+def cache_get(key: str) -> Optional[dict]:
+    """Returns cached Gemini metadata for key, or None on miss or cache failure."""
+    try:
+        return response_cache.get(key)
+    except Exception as e:
+        logger.error(f"Response cache read failed: {e}")
+        return None
+
+def cache_put(key: str, metadata: dict):
+    """Stores Gemini metadata for key; failures are logged, never raised, so results are still returned."""
+    try:
+        response_cache.set(key, metadata)
+    except Exception as e:
+        logger.error(f"Response cache write failed: {e}")
+
+def _retry_delay(retry_after: Optional[str], attempt: int) -> float:
+    """Seconds to wait before retry number attempt+1: Retry-After if numeric, else exponential backoff."""
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        delay = HTTP_BACKOFF_FACTOR * (2 ** attempt)
+    return min(max(delay, 0), HTTP_MAX_BACKOFF)
+
+async def post_with_retry(url: str, make_body: Callable[[], object], headers: Optional[dict] = None) -> bytes:
+    """
+    POSTs through the shared session, retrying HTTP_RETRY_STATUSES, connection errors and timeouts
+    until HTTP_MAX_RETRIES or HTTP_RETRY_DEADLINE is reached, whichever comes first.
+    make_body is called per attempt so streamed bodies can be rebuilt; prebuilt bytes are reused as-is.
+    Returns the response body of the first non-retryable response.
+    """
+    deadline = time.monotonic() + HTTP_RETRY_DEADLINE
+
+    def can_retry(attempt: int, delay: float) -> bool:
+        return attempt < HTTP_MAX_RETRIES and time.monotonic() + delay < deadline
+
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        # Each attempt's timeout is clipped so the last one cannot overrun the deadline
+        timeout = aiohttp.ClientTimeout(total=max(min(HTTP_TIMEOUT.total, deadline - time.monotonic()), 1))
+        try:
+            async with http_session.post(url, data=make_body(), headers=headers, timeout=timeout) as response:
+                delay = _retry_delay(response.headers.get("Retry-After"), attempt)
+                if response.status not in HTTP_RETRY_STATUSES or not can_retry(attempt, delay):
+                    response.raise_for_status()
+                    return await response.read()
+                reason = f"HTTP {response.status}"
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            delay = _retry_delay(None, attempt)
+            if not can_retry(attempt, delay):
+                raise
+            reason = str(e) or type(e).__name__
+
+        logger.warning(f"Gemini request failed ({reason}), retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+async def upload_to_gemini(filepath: str, mime_type: str, display_name: str, api_key: str) -> dict:
+    """
+    Uploads raw image bytes to the Gemini Files API as multipart/related.
+    The file object is streamed by aiohttp in chunks, never held in memory whole.
+    Returns the file_data part referencing the uploaded file.
+    """
+    url = f"{GEMINI_API_BASE}/upload/v1beta/files?key={api_key}"
+    headers = {"X-Goog-Upload-Protocol": "multipart"}
+
+    def make_body():
+        # aiohttp closes the file once the payload is sent, so each attempt reopens it
+        mpwriter = aiohttp.MultipartWriter("related")
+        mpwriter.append_json({"file": {"display_name": display_name}})
+        mpwriter.append(open(filepath, "rb"), {"Content-Type": mime_type})
+        return mpwriter
+
+    data = orjson.loads(await post_with_retry(url, make_body, headers))
+
+    return {"file_data": {"mime_type": data["file"]["mimeType"], "file_uri": data["file"]["uri"]}}
+
+# (session_id, filename, mtime_ns, api_key) -> (uploaded_at, file_data part), in LRU order
+gemini_files: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+def forget_gemini_files(session_id: str, filenames: Optional[List[str]] = None):
+    """Drops cached handles for a session, or only for the given filenames in it."""
+    for key in list(gemini_files):
+        if key[0] == session_id and (filenames is None or key[1] in filenames):
+            del gemini_files[key]
+
+async def get_gemini_file(session_id: str, filename: str, api_key: str, sem: asyncio.Semaphore) -> dict:
+    """
+    Returns the file_data part for a session image, preparing and uploading it only
+    on the first analysis; re-analysis of an unchanged file reuses the cached handle.
+    The upload itself holds one slot of sem.
+    """
+    session_path = os.path.join(TEMP_DIR, session_id)
+    mtime_ns = os.stat(os.path.join(session_path, filename)).st_mtime_ns
+    key = (session_id, filename, mtime_ns, api_key)
+
+    cached = gemini_files.get(key)
+    if cached and time.monotonic() - cached[0] < GEMINI_FILE_TTL:
+        gemini_files.move_to_end(key)
+        return cached[1]
+
+    upload_path, mime_type = await asyncio.to_thread(prepare_for_gemini, session_path, filename)
+    async with sem:
+        file_part = await upload_to_gemini(upload_path, mime_type, filename, api_key)
+
+    gemini_files[key] = (time.monotonic(), file_part)
+    gemini_files.move_to_end(key)
+    while len(gemini_files) > GEMINI_FILE_CACHE_SIZE:
+        gemini_files.popitem(last=False)
+    return file_part
+
+class ExifTool:
+    """
+    Persistent exiftool process (-stay_open) fed one arg-file block per image,
+    so Perl startup is paid once per batch instead of once per file.
+    """
+
+    def __enter__(self):
+        self.proc = subprocess.Popen(
+            ["exiftool", "-stay_open", "True", "-@", "-"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            encoding="utf-8",
+        )
+        self._seq = 0
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.proc.stdin.write("-stay_open\nFalse\n")
+            self.proc.stdin.flush()
+            self.proc.communicate(timeout=10)
+        except Exception:
+            self.proc.kill()
+
+    def execute(self, *args: str) -> tuple:
+        """Runs one command; returns (stdout, stderr) up to the ready sentinel."""
+        self._seq += 1
+        sentinel = f"{{ready{self._seq}}}"
+        # One arg per line; strip newlines so values cannot inject extra args
+        lines = [arg.replace("\r", " ").replace("\n", " ") for arg in args]
+        lines += ["-echo4", sentinel, f"-execute{self._seq}"]
+        self.proc.stdin.write("\n".join(lines) + "\n")
+        self.proc.stdin.flush()
+        return self._read_until(self.proc.stdout, sentinel), self._read_until(self.proc.stderr, sentinel)
+
+    @staticmethod
+    def _read_until(stream, sentinel: str) -> str:
+        out = []
+        for line in iter(stream.readline, ""):
+            if line.rstrip("\r\n") == sentinel:
+                break
+            out.append(line)
+        else:
+            raise RuntimeError("exiftool exited unexpectedly")
+        return "".join(out)
+
+def embed_metadata(session_path: str, metadata: List[MetadataItem], on_embedded: Optional[Callable[[str], None]] = None) -> List[str]:
+    """
+    Writes metadata into every existing image with one exiftool process.
+    on_embedded(filename) is called as soon as each file has been processed.
+    Returns error logs.
+    """
+    embed_errors = []
+    with ExifTool() as et:
+        for item in metadata:
+            image_path = os.path.join(session_path, item.filename)
+            if not os.path.exists(image_path):
+                continue
+
+            _, stderr = et.execute(
+                "-overwrite_original",
+                f"-Title={item.title}",
+                f"-Description={item.description}",
+                f"-Keywords={item.keywords}",
+                f"-Category={item.category}",
+                f"-IPTC:Caption-Abstract={item.description}",
+                f"-IPTC:Keywords={item.keywords}",
+                f"-XMP:Title={item.title}",
+                f"-XMP:Description={item.description}",
+                f"-XMP:Subject={item.keywords}",
+                image_path
+            )
+            if "Error" in stderr:
+                embed_errors.append(f"ExifTool failed for {item.filename}: {stderr}")
+            if on_embedded:
+                on_embedded(item.filename)
+    return embed_errors
+
+class TunedFTP(FTP):
+    """FTP client that enlarges the send buffer on each data connection."""
+
+    def ntransfercmd(self, cmd, rest=None):
+        conn, size = super().ntransfercmd(cmd, rest)
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, FTP_SNDBUF)
+        return conn, size
+
+# Queue marker telling an upload worker there is nothing left to send
+_UPLOAD_DONE = object()
+
+# Errors that mean the FTP connection itself is unusable, not that one file was refused
+FTP_CONNECTION_ERRORS = (OSError, EOFError, error_temp)
+
+def _drain(files: queue.Queue) -> List[str]:
+    """Empties the queue, returning the filenames left in it (sentinels dropped)."""
+    left = []
+    while True:
+        try:
+            filename = files.get_nowait()
+        except queue.Empty:
+            return left
+        if filename is not _UPLOAD_DONE:
+            left.append(filename)
+
+def _upload_worker(host: str, user: str, passwd: str, session_path: str, files: queue.Queue) -> tuple:
+    """
+    Uploads queued filenames over one dedicated FTP connection until _UPLOAD_DONE.
+    If the connection breaks, the current file is put back for the other workers and this one stops.
+    Returns (uploaded, errors).
+    """
+    uploaded, errors = [], []
+    with TunedFTP(host) as ftp:
+        ftp.login(user=user, passwd=passwd)
+        ftp.set_pasv(True)
+
+        while (filename := files.get()) is not _UPLOAD_DONE:
+            try:
+                f = open(os.path.join(session_path, filename), "rb")
+            except OSError as e:
+                errors.append(f"FTP Upload failed for {filename}: {e}")
+                continue
+
+            with f:
+                try:
+                    ftp.storbinary(f"STOR {filename}", f, blocksize=FTP_BLOCKSIZE)
+                    uploaded.append(filename)
+                except FTP_CONNECTION_ERRORS as e:
+                    logger.warning(f"FTP connection lost while uploading {filename}, handing it back: {e}")
+                    files.put(filename)
+                    break
+                except Exception as e:
+                    errors.append(f"FTP Upload failed for {filename}: {e}")
+    return uploaded, errors
+
+def embed_and_upload_files(request: EmbedUploadRequest, session_path: str) -> tuple:
+    """
+    Pipelines ExifTool embedding with FTP upload: each file is queued to up to
+    FTP_WORKERS upload connections as soon as its metadata is written, so
+    embedding the next file overlaps with uploading the previous ones.
+    Returns (embed_errors, uploaded, upload_errors, connection_error), where
+    connection_error is set only if no FTP connection could be established.
+    """
+    # Unsafe names could point outside the session dir: report them instead of touching them
+    rejected = [item.filename for item in request.metadata if item.filename != secure_filename(item.filename)]
+    items = [
+        item for item in request.metadata
+        if item.filename not in rejected
+        and os.path.exists(os.path.join(session_path, item.filename))
+    ]
+    workers = min(FTP_WORKERS, len(items))
+    files = queue.Queue()
+    queued = set()
+
+    def enqueue(filename: str):
+        queued.add(filename)
+        files.put(filename)
+
+    uploaded, connection_errors = [], []
+    upload_errors = [f"FTP Upload failed for {filename}: invalid filename" for filename in rejected]
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        futures = [
+            pool.submit(_upload_worker, request.ftp_host, request.ftp_user, request.ftp_pass, session_path, files)
+            for _ in range(workers)
+        ]
+
+        embed_errors = []
+        try:
+            embed_errors = embed_metadata(session_path, items, on_embedded=enqueue)
+        except Exception as e:
+            embed_errors.append(f"ExifTool failed: {e}")
+        finally:
+            # Always release the workers: files exiftool never reached are still uploaded as-is,
+            # then one sentinel per worker so none is left blocked in files.get()
+            for item in items:
+                if item.filename not in queued:
+                    enqueue(item.filename)
+            for _ in range(workers):
+                files.put(_UPLOAD_DONE)
+
+        for future in futures:
+            try:
+                ok, failed = future.result()
+            except Exception as e:
+                connection_errors.append(e)
+                continue
+            uploaded.extend(ok)
+            upload_errors.extend(failed)
+
+    if connection_errors and len(connection_errors) < workers:
+        logger.warning(f"{len(connection_errors)} of {workers} FTP connections failed, others uploaded their files: {connection_errors}")
+    connection_error = connection_errors[0] if workers and len(connection_errors) == workers else None
+
+    # Files handed back after a dropped connection (possibly behind the sentinels) get one
+    # more pass on a fresh connection; whatever still remains is reported as failed
+    leftovers = _drain(files)
+    if leftovers and not connection_error:
+        retry = queue.Queue()
+        for filename in leftovers:
+            retry.put(filename)
+        retry.put(_UPLOAD_DONE)
+        try:
+            ok, failed = _upload_worker(request.ftp_host, request.ftp_user, request.ftp_pass, session_path, retry)
+        except Exception as e:
+            ok, failed = [], [f"FTP Upload failed for {filename}: {e}" for filename in _drain(retry)]
+        uploaded.extend(ok)
+        upload_errors.extend(failed)
+        leftovers = _drain(retry)
+    upload_errors.extend(f"FTP Upload failed for {filename}: connection lost" for filename in leftovers)
+    return embed_errors, uploaded, upload_errors, connection_error
+
+# Anything but word characters, dots, dashes and spaces is replaced in uploaded filenames
+_UNSAFE_FILENAME_CHARS = re.compile(r"[^\w. -]+")
+
+def secure_filename(filename: str) -> str:
+    """
+    Reduces a client-supplied filename to a single safe path component:
+    directories are dropped, unsafe characters replaced, leading dots stripped.
+    Returns "" if nothing usable is left.
+    """
+    name = _UNSAFE_FILENAME_CHARS.sub("_", os.path.basename(filename.replace("\\", "/")))
+    # Dots and spaces are stripped together so " .env" or ". .x" cannot leave a leading dot behind
+    name = name.strip().lstrip(". ").strip()
+    return "" if name in {".", ".."} else name
+
+def get_session_path(session_id: str) -> str:
+    """Returns the directory of an existing session; 404 for unknown or malformed IDs."""
+    try:
+        valid = str(uuid.UUID(session_id)) == session_id
+    except ValueError:
+        valid = False
+    if not valid:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    session_path = os.path.join(TEMP_DIR, session_id)
+    if not os.path.exists(session_path):
+        raise HTTPException(status_code=404, detail="Session not found")
+    return session_path
+
+async def cleanup_session(session_id: str):
+    """
+    Deletes the session directory and forgets its uploaded Gemini files.
+    Async so gemini_files is only ever touched from the event loop.
+    """
     session_path = os.path.join(TEMP_DIR, session_id)
     if os.path.exists(session_path):
         try:
-            shutil.rmtree(session_path)
+            await asyncio.to_thread(shutil.rmtree, session_path)
+            forget_gemini_files(session_id)
             logger.info(f"Cleaned up session: {session_id}")
         except Exception as e:
             logger.error(f"Error cleaning up session {session_id}: {e}")
@@ -84,108 +625,201 @@ async def upload_files(files: List[UploadFile] = File(...)):
     session_path = os.path.join(TEMP_DIR, session_id)
     os.makedirs(session_path, exist_ok=True)
 
-    file_list = []
-
+    # Resolve unique destination names up front so concurrent writes never share a path;
+    # later duplicates (including names that collide after sanitizing) get a -N suffix
+    targets = []
+    used = set()
     for file in files:
+        filename = secure_filename(file.filename or "")
+        if not filename:
+            logger.error(f"Failed to upload {file.filename}: invalid filename")
+            continue
+        stem, ext = os.path.splitext(filename)
+        suffix = 1
+        while filename in used:
+            filename = f"{stem}-{suffix}{ext}"
+            suffix += 1
+        used.add(filename)
+        targets.append((file, filename))
+
+    def save_one(file: UploadFile, filename: str) -> Optional[str]:
         try:
-            file_location = os.path.join(session_path, file.filename)
-            # Safe async file write
-            content = await file.read()
+            file_location = os.path.join(session_path, filename)
+            # Stream the spooled upload to disk in 1MB chunks
             with open(file_location, 'wb') as f:
-                f.write(content)
+                shutil.copyfileobj(file.file, f, COPY_CHUNK_SIZE)
             
             # Construct accessible URL (assuming frontend can access /temp via proxy or direct)
             # For this setup, we return filename and frontend constructs URL: API_URL + /temp/ + session_id + / + filename
-            file_list.append(file.filename)
+            return filename
         except Exception as e:
             logger.error(f"Failed to upload {file.filename}: {e}")
             # Continue with other files or raise? Continuing seems better for UX.
+            return None
+
+    # Write all files concurrently on worker threads, keeping the event loop free
+    saved = await asyncio.gather(*(asyncio.to_thread(save_one, file, filename) for file, filename in targets))
+    file_list = [filename for filename in saved if filename is not None]
 
     return {"session_id": session_id, "files": file_list}
 
 @app.post("/analyze")
 async def analyze_images(request: AnalyzeRequest):
     """
-    1. Iterates images in session.
-    2. Sends to Gemini with optional context.
+    1. Iterates images in session, analyzing byte-identical duplicates once.
+    2. Sends uncached images to Gemini in concurrent batches (bounded) with optional context.
     3. Returns JSON list of metadata.
     """
-    session_path = os.path.join(TEMP_DIR, request.session_id)
-    if not os.path.exists(session_path):
-        raise HTTPException(status_code=404, detail="Session not found")
-
-    results = []
+    session_path = get_session_path(request.session_id)
 
     # Get list of image files
     try:
-        image_files = [f for f in os.listdir(session_path) if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
+        with os.scandir(session_path) as entries:
+            image_files = [
+                entry.name for entry in entries
+                if entry.is_file(follow_symlinks=False)
+                and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS
+            ]
     except Exception as e:
          raise HTTPException(status_code=500, detail=f"Error reading session dir: {e}")
 
     # Gemini Setup
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={request.api_key}"
-    headers = {'Content-Type': 'application/json'}
-
-    for filename in image_files:
-        filepath = os.path.join(session_path, filename)
-        
-        # Get Context
-        user_context = request.context_map.get(filename, "")
-        
-        system_prompt = (
-            "Analyze this image for stock photography. "
-            "Return PURE JSON (no markdown formatting) with keys: Title, Description, Keywords (comma separated string), Category (Choose from standard stock categories). "
-            f"Additional Context provided by user: '{user_context}'. Override visual inferences if this context contradicts them."
-        )
+    url = f"{GEMINI_API_BASE}/v1beta/models/{GEMINI_MODEL}:generateContent?key={request.api_key}"
+    sem = asyncio.Semaphore(GEMINI_CONCURRENCY)
 
-        try:
-             with open(filepath, "rb") as image_file:
-                encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-
-             payload = {
-                "contents": [{
-                    "parts": [
-                        {"text": system_prompt},
-                        {"inline_data": {
-                            "mime_type": "image/jpeg", # simplified
-                            "data": encoded_string
-                        }}
-                    ]
-                }]
-            }
-             
-             response = requests.post(url, headers=headers, json=payload)
-             response.raise_for_status()
-             data = response.json()
-             
-             # Extract text response - handling potential structure variations
-             try:
-                text_content = data['candidates'][0]['content']['parts'][0]['text']
-             except (KeyError, IndexError):
-                 logger.error(f"Unexpected Gemini response structure: {data}")
-                 raise ValueError("Invalid API response format")
-
-             # Cleanup json
-             clean_json = text_content.replace("```json", "").replace("```", "").strip()
-             metadata = json.loads(clean_json)
-             
-             results.append({
-                 "filename": filename,
-                 "title": metadata.get("Title", ""),
-                 "description": metadata.get("Description", ""),
-                 "keywords": metadata.get("Keywords", ""),
-                 "category": metadata.get("Category", "")
-             })
+    def context_for(filename: str) -> str:
+        return request.context_map.get(filename, "")
 
-        except Exception as e:
-            logger.error(f"Error processing {filename}: {e}")
+    async def generate(parts: list, system_instruction: dict, generation_config: dict, filenames: List[str]):
+        payload = {
+            "system_instruction": system_instruction,
+            "generation_config": generation_config,
+            "contents": [{"parts": parts}]
+        }
+
+        # Serialized once; retries resend the same bytes
+        body = orjson.dumps(payload)
+        try:
+            async with sem:
+                data = orjson.loads(await post_with_retry(url, lambda: body, JSON_HEADERS))
+        except aiohttp.ClientResponseError as e:
+            # A rejected request may mean a stale or invalid file_uri: re-upload next time
+            if 400 <= e.status < 500 and e.status != 429:
+                forget_gemini_files(request.session_id, filenames)
+            raise
+
+        # Extract text response - handling potential structure variations
+        try:
+            text_content = data['candidates'][0]['content']['parts'][0]['text']
+        except (KeyError, IndexError):
+            logger.error(f"Unexpected Gemini response structure: {data}")
+            raise ValueError("Invalid API response format")
+
+        # response_mime_type guarantees bare JSON, no markdown fences to strip
+        return orjson.loads(text_content)
+
+    async def analyze_single(filename: str) -> dict:
+        parts = [await get_gemini_file(request.session_id, filename, request.api_key, sem)]
+        if context_for(filename):
+            parts.append({"text": f"Additional Context provided by user: '{context_for(filename)}'"})
+
+        metadata = await generate(parts, GEMINI_SYSTEM_INSTRUCTION, GEMINI_GENERATION_CONFIG, [filename])
+        if not isinstance(metadata, dict):
+            raise ValueError("Invalid API response format")
+        return metadata
+
+    async def analyze_batch(batch: List[tuple]) -> dict:
+        """
+        Analyzes (cache_key, filename) pairs in one generateContent call.
+        Files the batch response is missing, or a malformed batch response, are retried per file;
+        upload and HTTP errors are recorded against the affected files without a retry.
+        Returns cache_key -> metadata dict, or the Exception that file failed with.
+        """
+        results = {}
+        if len(batch) > 1:
+            file_parts = await asyncio.gather(
+                *(get_gemini_file(request.session_id, filename, request.api_key, sem) for _, filename in batch),
+                return_exceptions=True,
+            )
+            uploaded = []
+            for (key, filename), file_part in zip(batch, file_parts):
+                if isinstance(file_part, Exception):
+                    results[key] = file_part
+                else:
+                    uploaded.append((key, filename, file_part))
+
+            parts = []
+            for _, filename, file_part in uploaded:
+                label = f"Filename: {filename}"
+                if context_for(filename):
+                    label += f"\nAdditional Context provided by user: '{context_for(filename)}'"
+                parts += [{"text": label}, file_part]
+
+            if uploaded:
+                try:
+                    items = await generate(parts, GEMINI_BATCH_SYSTEM_INSTRUCTION, GEMINI_BATCH_GENERATION_CONFIG, [filename for _, filename, _ in uploaded])
+                    if not isinstance(items, list):
+                        raise ValueError("Invalid API response format")
+                    by_filename = {item.get("Filename"): item for item in items if isinstance(item, dict)}
+                    results.update({key: by_filename[filename] for key, filename, _ in uploaded if filename in by_filename})
+                except ValueError as e:
+                    # Covers orjson.JSONDecodeError; only a malformed response is worth retrying per file
+                    logger.warning(f"Batch response unusable, falling back to per-file requests: {e}")
+                except Exception as e:
+                    logger.error(f"Batch analysis failed: {e}")
+                    results.update({key: e for key, _, _ in uploaded})
+
+        missing = [(key, filename) for key, filename in batch if key not in results]
+        outcomes = await asyncio.gather(*(analyze_single(filename) for _, filename in missing), return_exceptions=True)
+        results.update({key: outcome for (key, _), outcome in zip(missing, outcomes)})
+
+        await asyncio.gather(*(
+            asyncio.to_thread(cache_put, key, metadata)
+            for key, metadata in results.items() if not isinstance(metadata, Exception)
+        ))
+        return results
+
+    # Hash every file; byte-identical files with the same context share one cache key and one analysis
+    keys = await asyncio.gather(
+        *(asyncio.to_thread(response_cache_key, os.path.join(session_path, f), context_for(f)) for f in image_files),
+        return_exceptions=True
+    )
+    canonical: Dict[str, str] = {}
+    for filename, key in zip(image_files, keys):
+        if not isinstance(key, Exception):
+            canonical.setdefault(key, filename)
+
+    # Identical bytes + context were analyzed before: skip the upload and the bill
+    cached = await asyncio.gather(*(asyncio.to_thread(cache_get, key) for key in canonical))
+    metadata_by_key = {key: metadata for key, metadata in zip(canonical, cached) if metadata is not None}
+
+    # Remaining files go to Gemini in batches, run concurrently and bounded by the semaphore
+    misses = [(key, filename) for key, filename in canonical.items() if key not in metadata_by_key]
+    batches = [misses[i:i + GEMINI_BATCH_SIZE] for i in range(0, len(misses), GEMINI_BATCH_SIZE)]
+    for batch_results in await asyncio.gather(*(analyze_batch(batch) for batch in batches)):
+        metadata_by_key.update(batch_results)
+
+    # Expand back to every file, in image_files order
+    results = []
+    for filename, key in zip(image_files, keys):
+        metadata = key if isinstance(key, Exception) else metadata_by_key[key]
+        if isinstance(metadata, Exception):
+            logger.error(f"Error processing {filename}: {metadata}")
             results.append({
                 "filename": filename,
                 "title": "Error Processing",
-                "description": str(e),
+                "description": str(metadata),
                 "keywords": "",
                 "category": ""
             })
+        else:
+            results.append({
+                "filename": filename,
+                "title": metadata.get("Title", ""),
+                "description": metadata.get("Description", ""),
+                "keywords": metadata.get("Keywords", ""),
+                "category": metadata.get("Category", "")
+            })
 
     return {"results": results}
 
@@ -193,70 +827,23 @@ async def analyze_images(request: AnalyzeRequest):
 async def embed_and_upload(request: EmbedUploadRequest, background_tasks: BackgroundTasks):
     """
     1. Embed metadata via ExifTool.
-    2. Upload to FTP.
+    2. Upload to FTP, overlapping with embedding.
     3. Trigger cleanup.
     """
-    session_path = os.path.join(TEMP_DIR, request.session_id)
-    if not os.path.exists(session_path):
-        raise HTTPException(status_code=404, detail="Session not found")
+    session_path = get_session_path(request.session_id)
 
-    embed_errors = []
-    
-    # --- Embedding ---
-    for item in request.metadata:
-        image_path = os.path.join(session_path, item.filename)
-        if not os.path.exists(image_path):
-            continue
-
-        cmd = [
-            "exiftool",
-            "-overwrite_original",
-            f"-Title={item.title}",
-            f"-Description={item.description}",
-            f"-Keywords={item.keywords}",
-            f"-Category={item.category}", 
-            f"-IPTC:Caption-Abstract={item.description}",
-            f"-IPTC:Keywords={item.keywords}",
-            f"-XMP:Title={item.title}",
-            f"-XMP:Description={item.description}",
-            f"-XMP:Subject={item.keywords}",
-            image_path
-        ]
-        
-        try:
-            subprocess.run(cmd, capture_output=True, text=True, check=True)
-        except subprocess.CalledProcessError as e:
-            embed_errors.append(f"ExifTool failed for {item.filename}: {e.stderr}")
+    # --- Embedding + FTP Upload (pipelined) ---
+    embed_errors, uploaded_files, upload_errors, connection_error = await asyncio.to_thread(
+        embed_and_upload_files, request, session_path
+    )
 
     if embed_errors:
         logger.warning(f"Embedding errors: {embed_errors}")
         # We continue to upload what we can, or return error? 
         # Requirement says "execute embedding... return logs". We will return logs but proceed.
 
-    # --- FTP Upload ---
-    uploaded_files = []
-    upload_errors = []
-
-    try:
-        with FTP(request.ftp_host) as ftp:
-            ftp.login(user=request.ftp_user, passwd=request.ftp_pass)
-            
-            for item in request.metadata:
-                filename = item.filename
-                file_path = os.path.join(session_path, filename)
-                
-                if not os.path.exists(file_path): 
-                    continue
-
-                try:
-                    with open(file_path, "rb") as f:
-                        ftp.storbinary(f"STOR {filename}", f)
-                    uploaded_files.append(filename)
-                except Exception as e:
-                    upload_errors.append(f"FTP Upload failed for {filename}: {e}")
-                    
-    except Exception as e:
-         return {"status": "failed", "error": f"FTP Connection failed: {str(e)}", "embed_errors": embed_errors}
+    if connection_error:
+         return {"status": "failed", "error": f"FTP Connection failed: {str(connection_error)}", "embed_errors": embed_errors}
 
     # Queue Cleanup
     background_tasks.add_task(cleanup_session, request.session_id)